@@ -1,18 +1,30 @@
+import asyncio
+import functools
 import logging
+import math
 import os
+import pickle
+import random
+import re
+from copy import deepcopy
 from datetime import datetime
-from zoneinfo import ZoneInfo
+from pathlib import Path
 
+import orjson
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update
+from telegram.constants import ParseMode
+from telegram.error import BadRequest, RetryAfter
 from telegram.ext import (
+    AIORateLimiter,
     Application,
+    BasePersistence,
     CallbackQueryHandler,
     CommandHandler,
     ContextTypes,
     ConversationHandler,
     MessageHandler,
+    PersistenceInput,
     filters,
-    PicklePersistence,
 )
 
 # Enable logging
@@ -22,100 +34,330 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 # Timezone
-TZ = ZoneInfo("Asia/Yekaterinburg")
+TZ_NAME = "Asia/Yekaterinburg"
+
+
+@functools.cache
+def _tz():
+    """Bot timezone, constructed on first use to keep import time down."""
+    from zoneinfo import ZoneInfo  # deferred: the tzdata lookup is not free
+
+    return ZoneInfo(TZ_NAME)
 
 # Stages
 START_ROUTES, GET_AMOUNT, GET_DESCRIPTION = range(3)
-# Callback data
-ADD_INCOME, ADD_EXPENSE = 'add_income', 'add_expense'
+# Callback data — single-char codes keep every callback update payload small
+ADD_INCOME, ADD_EXPENSE = 'i', 'e'
+# Transaction types — int flags compare faster and encode smaller than the
+# old "income"/"expense" strings, and match the tx_is_income column values
+INCOME, EXPENSE = 1, 0
+
+# Static UI objects — the menu never changes, so build it once at import
+MAIN_MENU_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("➕ Добавить доход", callback_data=ADD_INCOME)],
+    [InlineKeyboardButton("➖ Добавить расход", callback_data=ADD_EXPENSE)],
+])
+MENU_CALLBACK_PATTERN = re.compile(rf"^({ADD_INCOME}|{ADD_EXPENSE})$")
+TEXT_NO_COMMAND = filters.TEXT & ~filters.COMMAND
+INCOME_EMOJI, EXPENSE_EMOJI = "✅", "🔻"
+
+
+class JsonPersistence(BasePersistence):
+    """Persists user_data as orjson-encoded JSON, sharded per user.
+
+    Everything the bot stores is primitives (floats, strings, ISO dates,
+    small lists), which orjson encodes faster and smaller than pickle's
+    opcode stream — and loading the files back cannot execute code.
+    Each user lives in its own <dirpath>/<user_id>.json shard and a
+    dirty set tracks which records changed, so a write only re-encodes
+    the users touched since the last flush instead of the whole user
+    base. PTB asks for the full user_data mapping once at startup, so
+    all shards are read then; only writes are incremental.
+    """
+
+    def __init__(self, dirpath: str, update_interval: float = 60, on_flush: bool = False):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, callback_data=False),
+            update_interval=update_interval,
+        )
+        self.dirpath = Path(dirpath)
+        self.dirpath.mkdir(parents=True, exist_ok=True)
+        self.on_flush = on_flush
+        self._user_data = None
+        self._dirty_users = set()
+
+    def _load(self) -> None:
+        if self._user_data is not None:
+            return
+        self._user_data = {}
+        # One-time migration from the old single-file layout
+        legacy = Path(f"{self.dirpath}.json")
+        if legacy.exists():
+            raw = orjson.loads(legacy.read_bytes())
+            # JSON object keys are always strings; user IDs are ints.
+            self._user_data = {int(uid): data for uid, data in raw.items()}
+            self._dirty_users.update(self._user_data)
+        # One-time migration from the original PicklePersistence file,
+        # only when no JSON data exists yet — losing user balances on
+        # upgrade is not an option
+        legacy_pickle = Path(f"{self.dirpath}.pickle")
+        if (
+            legacy_pickle.exists()
+            and not self._user_data
+            and not any(self.dirpath.glob('*.json'))
+        ):
+            with legacy_pickle.open('rb') as file:
+                self._user_data = pickle.load(file).get('user_data') or {}
+            self._dirty_users.update(self._user_data)
+            self._flush_dirty()
+            legacy_pickle.rename(f"{legacy_pickle}.migrated")
+        for shard in self.dirpath.glob('*.json'):
+            self._user_data[int(shard.stem)] = orjson.loads(shard.read_bytes())
+        # Retire the legacy file once its users are sharded, so restarts
+        # don't re-dirty every user or resurrect ones dropped since
+        if legacy.exists():
+            self._flush_dirty()
+            legacy.rename(f"{legacy}.migrated")
+
+    def _dump_user(self, user_id: int) -> None:
+        shard = self.dirpath / f"{user_id}.json"
+        tmp_path = shard.with_suffix('.tmp')
+        tmp_path.write_bytes(orjson.dumps(self._user_data[user_id]))
+        os.replace(tmp_path, shard)
+
+    def _flush_dirty(self) -> None:
+        while self._dirty_users:
+            self._dump_user(self._dirty_users.pop())
+
+    async def get_user_data(self):
+        self._load()
+        return deepcopy(self._user_data)
+
+    async def update_user_data(self, user_id: int, data: dict) -> None:
+        self._load()
+        if self._user_data.get(user_id) == data:
+            return
+        self._user_data[user_id] = data
+        self._dirty_users.add(user_id)
+        if not self.on_flush:
+            self._flush_dirty()
+
+    async def refresh_user_data(self, user_id: int, user_data: dict) -> None:
+        pass
+
+    async def drop_user_data(self, user_id: int) -> None:
+        self._load()
+        self._user_data.pop(user_id, None)
+        self._dirty_users.discard(user_id)
+        (self.dirpath / f"{user_id}.json").unlink(missing_ok=True)
+
+    async def flush(self) -> None:
+        if self._user_data is not None:
+            self._flush_dirty()
+
+    # The bot keeps no chat/bot/callback data and its ConversationHandler
+    # is not persistent, so the remaining hooks are no-ops.
+    async def get_chat_data(self):
+        return {}
+
+    async def update_chat_data(self, chat_id: int, data: dict) -> None:
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict) -> None:
+        pass
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        pass
+
+    async def get_bot_data(self):
+        return {}
+
+    async def update_bot_data(self, data: dict) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data: dict) -> None:
+        pass
+
+    async def get_callback_data(self):
+        return None
 
-def get_user_stats(user_data):
+    async def update_callback_data(self, data) -> None:
+        pass
+
+    async def get_conversations(self, name: str):
+        return {}
+
+    async def update_conversation(self, name: str, key, new_state) -> None:
+        pass
+
+def _column_totals(amounts, is_income):
+    """Sums the income and expense columns, vectorizing for large days.
+
+    numpy only wins once the array amortizes the conversion overhead,
+    so short lists stay on the plain-Python path.
+    """
+    if len(amounts) > 32:
+        import numpy as np  # deferred import keeps cold start light
+
+        values = np.asarray(amounts, dtype=np.float64)
+        mask = np.asarray(is_income, dtype=bool)
+        return float(values[mask].sum()), float(values[~mask].sum())
+    total_income = sum(a for a, i in zip(amounts, is_income) if i)
+    total_expense = sum(a for a, i in zip(amounts, is_income) if not i)
+    return total_income, total_expense
+
+
+def get_user_stats(user_data, now=None):
     """Calculates and returns financial statistics for the user for today."""
-    today_str = datetime.now(TZ).strftime("%Y-%m-%d")
-    
+    # datetime.now(tz) + strftime is heavy; compute once and derive both strings
+    if now is None:
+        now = datetime.now(_tz())
+    today_str = now.strftime("%Y-%m-%d")
+
+    # Migrate users persisted before the column layout existed. This must
+    # run before the rollover below, otherwise an upgrade-day rollover
+    # would archive zeros and discard the records they came from.
+    if 'tx_amounts' not in user_data:
+        legacy = user_data.pop('transactions_today', [])
+        user_data['tx_amounts'] = [t['amount'] for t in legacy]
+        user_data['tx_is_income'] = [1 if t['type'] == 'income' else 0 for t in legacy]
+        user_data['tx_desc'] = [t.get('description', 'без описания') for t in legacy]
+        user_data['tx_date'] = [t['date'] for t in legacy]
+
+    # Migrate users persisted before the running totals existed
+    if 'total_income' not in user_data:
+        user_data['total_income'], user_data['total_expense'] = _column_totals(
+            user_data['tx_amounts'], user_data['tx_is_income']
+        )
+
     # Initialize data for new user or new day
     if 'last_update' not in user_data or user_data.get('last_update') != today_str:
+        prev_date = user_data.get('last_update')
+        if prev_date is not None:
+            # Archive a compact per-day summary; the raw records are
+            # discarded so no list grows without bound
+            history = user_data.setdefault('history', [])
+            history.append({
+                'date': prev_date,
+                'income': user_data['total_income'],
+                'expense': user_data['total_expense'],
+            })
+            if len(history) > 365:
+                user_data['history'] = history[-365:]
         # Calculate previous day's end balance
         end_of_yesterday_balance = user_data.get('balance_end_day', 0.0)
         user_data['balance_start_day'] = end_of_yesterday_balance
-        user_data['transactions_today'] = []
+        user_data['tx_amounts'] = []
+        user_data['tx_is_income'] = []
+        user_data['tx_desc'] = []
+        user_data['tx_date'] = []
+        user_data['total_income'] = 0.0
+        user_data['total_expense'] = 0.0
         user_data['last_update'] = today_str
 
-    transactions = user_data.get('transactions_today', [])
-    
-    total_income = sum(t['amount'] for t in transactions if t['type'] == 'income')
-    total_expense = sum(t['amount'] for t in transactions if t['type'] == 'expense')
-    
+    amounts = user_data['tx_amounts']
+    is_income = user_data['tx_is_income']
+
+    total_income = user_data['total_income']
+    total_expense = user_data['total_expense']
+
     balance_start = user_data.get('balance_start_day', 0.0)
     balance_end = balance_start + total_income - total_expense
     user_data['balance_end_day'] = balance_end # Save for tomorrow
 
     return {
-        "date": datetime.now(TZ).strftime("%d %B %Y"),
+        "date": now.strftime("%d %B %Y"),
         "balance_start": balance_start,
         "total_income": total_income,
         "total_expense": total_expense,
         "balance_end": balance_end,
-        "transactions": transactions
+        "tx_amounts": amounts,
+        "tx_is_income": is_income,
+        "tx_desc": user_data['tx_desc'],
     }
 
-async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    """Display main menu and handle daily balance updates."""
-    user = update.effective_user
-    stats = get_user_stats(context.user_data)
-
-    text = (
-        f"Привет, {user.mention_html()}!\n\n"
-        f"📅 **Сегодня: {stats['date']}**\n"
-        f"💰 **На начало дня:** {stats['balance_start']:.2f}\n"
-        f"📈 **Доходы:** +{stats['total_income']:.2f}\n"
-        f"📉 **Расходы:** -{stats['total_expense']:.2f}\n"
-        f"🏦 **На конец дня:** {stats['balance_end']:.2f}\n\n"
-        f"**Последние операции:**\n"
-    )
+async def _send_with_retry(coro_factory, max_attempts=5):
+    """Awaits coro_factory(), backing off with jitter when Telegram floods us.
 
-    if not stats['transactions']:
-        text += "_Пока нет операций за сегодня._\n"
+    Re-sending immediately after a 429 only compounds the flood; instead
+    sleep retry_after scaled by uniform(0.5, 1.5) so retries from
+    concurrent chats stay desynchronized.
+    """
+    for attempt in range(max_attempts):
+        try:
+            return await coro_factory()
+        except RetryAfter as e:
+            if attempt == max_attempts - 1:
+                raise
+            await asyncio.sleep(e.retry_after * random.uniform(0.5, 1.5))
+
+
+def _build_menu(user, user_data, now=None):
+    """Builds the main-menu text and markup for the user's current stats."""
+    stats = get_user_stats(user_data, now)
+
+    lines = [
+        f"Привет, {user.mention_html()}!\n",
+        f"📅 **Сегодня: {stats['date']}**",
+        f"💰 **На начало дня:** {stats['balance_start']:.2f}",
+        f"📈 **Доходы:** +{stats['total_income']:.2f}",
+        f"📉 **Расходы:** -{stats['total_expense']:.2f}",
+        f"🏦 **На конец дня:** {stats['balance_end']:.2f}\n",
+        "**Последние операции:**",
+    ]
+
+    if not stats['tx_amounts']:
+        lines.append("_Пока нет операций за сегодня._")
     else:
-        for t in stats['transactions'][-5:]:
-            op_type = "✅" if t['type'] == 'income' else '🔻'
-            text += f"{op_type} {t['amount']:.2f} - {t.get('description', 'без описания')}\n"
+        lines.extend(
+            f"{INCOME_EMOJI if income else EXPENSE_EMOJI} {amount:.2f} - {desc}"
+            for amount, income, desc in zip(
+                stats['tx_amounts'][-5:], stats['tx_is_income'][-5:], stats['tx_desc'][-5:]
+            )
+        )
+    return "\n".join(lines), MAIN_MENU_MARKUP
 
-    keyboard = [
-        [InlineKeyboardButton("➕ Добавить доход", callback_data=ADD_INCOME)],
-        [InlineKeyboardButton("➖ Добавить расход", callback_data=ADD_EXPENSE)],
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+
+async def _send_main_menu(chat_id, user, context, now=None):
+    """Sends a fresh main-menu message and remembers its id."""
+    text, reply_markup = _build_menu(user, context.user_data, now)
+    message = await _send_with_retry(lambda: context.bot.send_message(
+        chat_id=chat_id,
+        text=text,
+        reply_markup=reply_markup,
+        parse_mode=ParseMode.HTML
+    ))
+    context.user_data['message_id'] = message.message_id
+
+
+async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Display main menu and handle daily balance updates."""
+    text, reply_markup = _build_menu(update.effective_user, context.user_data)
 
     message_id = context.user_data.get('message_id')
-    if update.callback_query or not message_id:
-        if update.callback_query:
-            await update.callback_query.answer()
-            await update.callback_query.edit_message_text(
-                text=text, reply_markup=reply_markup, parse_mode='HTML'
-            )
-        else: # This branch is for initial /start or our custom call
-            if update.message:
-                message = await update.message.reply_html(text, reply_markup=reply_markup)
-            else: # Fallback for calls without a message to reply to (e.g., after saving a transaction)
-                message = await context.bot.send_message(
-                    chat_id=update.effective_chat.id,
-                    text=text,
-                    reply_markup=reply_markup,
-                    parse_mode='HTML'
-                )
-            context.user_data['message_id'] = message.message_id
+    if update.callback_query:
+        await update.callback_query.answer()
+        await _send_with_retry(lambda: update.callback_query.edit_message_text(
+            text=text, reply_markup=reply_markup, parse_mode=ParseMode.HTML
+        ))
+    elif not message_id: # Initial /start
+        message = await _send_with_retry(
+            lambda: update.message.reply_html(text, reply_markup=reply_markup)
+        )
+        context.user_data['message_id'] = message.message_id
     else: # Edit existing message on /start command
         try:
-            await context.bot.edit_message_text(
+            await _send_with_retry(lambda: context.bot.edit_message_text(
                 chat_id=update.effective_chat.id,
                 message_id=message_id,
                 text=text,
                 reply_markup=reply_markup,
-                parse_mode='HTML'
-            )
+                parse_mode=ParseMode.HTML
+            ))
         except Exception:
-            message = await update.message.reply_html(text, reply_markup=reply_markup)
+            message = await _send_with_retry(
+                lambda: update.message.reply_html(text, reply_markup=reply_markup)
+            )
             context.user_data['message_id'] = message.message_id
 
     return START_ROUTES
@@ -126,10 +368,10 @@ async def ask_for_amount(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     query = update.callback_query
     await query.answer()
     
-    transaction_type = 'income' if query.data == ADD_INCOME else 'expense'
+    transaction_type = INCOME if query.data == ADD_INCOME else EXPENSE
     context.user_data['current_transaction'] = {'type': transaction_type}
-    
-    type_text = 'дохода' if transaction_type == 'income' else 'расхода'
+
+    type_text = 'дохода' if transaction_type == INCOME else 'расхода'
     await query.edit_message_text(text=f"Введите сумму {type_text}:")
     
     return GET_AMOUNT
@@ -138,6 +380,10 @@ async def ask_for_description(update: Update, context: ContextTypes.DEFAULT_TYPE
     """Stores the amount and asks for a description."""
     try:
         amount = float(update.message.text)
+        # float() accepts "nan"/"inf", which JSON cannot represent and
+        # which would poison the running totals — treat them as bad input
+        if not math.isfinite(amount):
+            raise ValueError(f"non-finite amount: {amount}")
         context.user_data['current_transaction']['amount'] = amount
     except (ValueError, TypeError):
         await update.message.reply_text("Это не похоже на число. Пожалуйста, введите сумму еще раз.")
@@ -150,41 +396,42 @@ async def save_transaction(update: Update, context: ContextTypes.DEFAULT_TYPE) -
     """Saves the complete transaction, cleans up messages, and shows a new main menu."""
     description = update.message.text
     transaction = context.user_data['current_transaction']
-    transaction['description'] = description
-    transaction['date'] = datetime.now(TZ).isoformat()
+    is_income = transaction['type']
+    now = datetime.now(_tz())  # reused for the record date and the menu render
 
-    if 'transactions_today' not in context.user_data:
-        context.user_data['transactions_today'] = []
-        
-    context.user_data['transactions_today'].append(transaction)
-    
-    # --- Clean up --- 
-    # Delete old main menu
-    old_menu_id = context.user_data.pop('message_id', None)
-    if old_menu_id:
-        try:
-            await context.bot.delete_message(chat_id=update.effective_chat.id, message_id=old_menu_id)
-        except Exception as e:
-            logger.info(f"Could not delete old menu message: {e}")
+    context.user_data.setdefault('tx_amounts', []).append(transaction['amount'])
+    context.user_data.setdefault('tx_is_income', []).append(is_income)
+    context.user_data.setdefault('tx_desc', []).append(description)
+    context.user_data.setdefault('tx_date', []).append(now.isoformat())
 
-    # Delete user's amount message, bot's description prompt, user's description message
-    # This is a bit tricky as we don't store all these IDs. A simpler approach for now
-    # is to just send a new menu and not worry about deleting user messages.
+    # Keep the running totals in sync so menu renders stay O(1)
+    total_key = 'total_income' if is_income else 'total_expense'
+    context.user_data[total_key] = context.user_data.get(total_key, 0.0) + transaction['amount']
 
     context.user_data.pop('current_transaction', None)
 
-    # --- Send new menu --- 
-    # We need to create a new update object for start() because the current one is a text message
-    # and we want start() to send a new message, not edit one.
-    class MockUpdate:
-        def __init__(self, effective_chat, effective_user):
-            self.effective_chat = effective_chat
-            self.effective_user = effective_user
-            self.callback_query = None
-            self.message = None # This will force start() to send a new message
-
-    mock_update = MockUpdate(update.effective_chat, update.effective_user)
-    return await start(mock_update, context)
+    # --- Refresh menu ---
+    # Edit the old menu in place: one API call instead of the previous
+    # delete + send pair, so half the latency and rate-limit quota.
+    old_menu_id = context.user_data.get('message_id')
+    if old_menu_id:
+        text, reply_markup = _build_menu(update.effective_user, context.user_data, now)
+        try:
+            await _send_with_retry(lambda: context.bot.edit_message_text(
+                chat_id=update.effective_chat.id,
+                message_id=old_menu_id,
+                text=text,
+                reply_markup=reply_markup,
+                parse_mode=ParseMode.HTML
+            ))
+            return START_ROUTES
+        except BadRequest as e:
+            # "message to edit not found" / "message is not modified"
+            logger.info(f"Could not edit old menu message: {e}")
+            context.user_data.pop('message_id', None)
+
+    await _send_main_menu(update.effective_chat.id, update.effective_user, context, now)
+    return START_ROUTES
 
 
 
@@ -201,22 +448,47 @@ def main() -> None:
             print("Ошибка: Не найден токен. Создайте переменную окружения BOT_TOKEN или файл bot_token.txt.")
             return
 
-    # Set up persistence
-    persistence = PicklePersistence(filepath="bot_data.pickle")
-
-    application = Application.builder().token(token).persistence(persistence).build()
+    # Use libuv's event loop when available; the stdlib loop is noticeably
+    # slower for the many small awaits in the handlers. uvloop does not
+    # support Windows, so fall back silently there.
+    try:
+        import uvloop
+        uvloop.install()
+    except ImportError:
+        pass
+
+    # Set up persistence; 120s batches flushes instead of writing per update
+    persistence = JsonPersistence(dirpath="bot_data", update_interval=120)
+
+    application = (
+        Application.builder()
+        .token(token)
+        .persistence(persistence)
+        # Throttle outbound API calls client-side so button spam cannot
+        # trip Telegram's per-chat flood limits and trigger 429 retries
+        .rate_limiter(
+            AIORateLimiter(
+                overall_max_rate=30,
+                overall_time_period=1,
+                group_max_rate=20,
+                group_time_period=60,
+                max_retries=3,
+            )
+        )
+        .build()
+    )
 
     conv_handler = ConversationHandler(
         entry_points=[CommandHandler("start", start)],
         states={
             START_ROUTES: [
-                CallbackQueryHandler(ask_for_amount, pattern=f"^({ADD_INCOME}|{ADD_EXPENSE})$"),
+                CallbackQueryHandler(ask_for_amount, pattern=MENU_CALLBACK_PATTERN),
             ],
             GET_AMOUNT: [
-                MessageHandler(filters.TEXT & ~filters.COMMAND, ask_for_description)
+                MessageHandler(TEXT_NO_COMMAND, ask_for_description)
             ],
             GET_DESCRIPTION: [
-                MessageHandler(filters.TEXT & ~filters.COMMAND, save_transaction)
+                MessageHandler(TEXT_NO_COMMAND, save_transaction)
             ],
         },
         fallbacks=[CommandHandler("start", start)],
@@ -224,8 +496,20 @@ def main() -> None:
 
     application.add_handler(conv_handler)
 
-    # Run the bot until the user presses Ctrl-C
-    application.run_polling()
+    # Prefer webhook mode: no idle getUpdates polling, lower update latency.
+    # allowed_updates keeps Telegram from sending update types we never handle.
+    webhook_host = os.getenv('WEBHOOK_HOST')
+    if webhook_host:
+        application.run_webhook(
+            listen="0.0.0.0",
+            port=int(os.getenv('PORT', 8443)),
+            url_path=token,
+            webhook_url=f"https://{webhook_host}/{token}",
+            allowed_updates=["message", "callback_query"],
+        )
+    else:
+        # Run the bot until the user presses Ctrl-C
+        application.run_polling(allowed_updates=["message", "callback_query"])
 
 
 if __name__ == "__main__":